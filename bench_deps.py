@@ -0,0 +1,224 @@
+"""
+Benchmark suite for deps.py, built on pyperf.
+
+Synthetic graphs (chain, fan-out, diamonds, random DAG) of increasing sizes are used to time
+DepGraph.add_node (and DepGraph.add_nodes, registering the same nodes in one batch), DepGraph.add_relationship,
+DepGraph.get_dependencies and DepGraph.get_dependents,
+neighbour lookups by full scan over DepGraph.relationships (the pre-index implementation) as a baseline,
+and extract_dependencies, with a cold and a warm signature cache.
+Importing deps in a fresh interpreter is timed too, against a bare interpreter startup.
+
+    python bench_deps.py -o timings.json [--shapes chain random] [--sizes 10 1000 100000]
+    python bench_deps.py --tracemalloc -o memory.json   # peak memory instead of time
+    python -m pyperf compare_to before.json after.json
+"""
+import functools
+import os
+import random
+import sys
+import time
+
+import pyperf
+
+import deps
+
+
+SHAPES = ("chain", "fanout", "diamond", "random")
+SIZES = (10, 100, 1000, 10000, 100000)
+LOOKUPS = 100
+# scanning relationships is O(E) per lookup: keep the baseline to graphs where it completes
+SCAN_MAX_SIZE = 10000
+
+
+def make_node(i: int) -> deps.Node:
+    return deps.Node(name=f"n{i}", dependency_type=deps.Dependency(factory=object, type=object))
+
+
+# edges are (dependent, dependence) index pairs, dependents always having the higher index
+
+def chain_edges(size: int):
+    return [(i + 1, i) for i in range(size - 1)]
+
+
+def fanout_edges(size: int):
+    return [(size - 1, i) for i in range(size - 1)]
+
+
+def diamond_edges(size: int):
+    # stacked diamonds: (left, right) -> base and top -> (left, right), each top being the next base
+    edges = []
+    for base in range(0, size - 3, 3):
+        edges += [(base + 1, base), (base + 2, base), (base + 3, base + 1), (base + 3, base + 2)]
+    return edges
+
+
+def random_edges(size: int, degree: int = 3, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        (i, j)
+        for i in range(1, size)
+        for j in rng.sample(range(i), min(i, degree))
+    ]
+
+
+def synthetic_edges(shape: str, size: int):
+    return {
+        "chain": chain_edges,
+        "fanout": fanout_edges,
+        "diamond": diamond_edges,
+        "random": random_edges,
+    }[shape](size)
+
+
+# a pyperf worker computes several values of the same benchmark: build its graph once
+@functools.lru_cache(maxsize=1)
+def build_graph(shape: str, size: int) -> deps.DepGraph:
+    graph = deps.DepGraph()
+    nodes = [make_node(i) for i in range(size)]
+    for node in nodes:
+        graph.add_node(node)
+    for dependent, dependence in synthetic_edges(shape, size):
+        graph.add_relationship(nodes[dependent].name, nodes[dependence].name)
+    return graph
+
+
+def bench_add_node(loops: int, shape: str, size: int) -> float:
+    # dependencies are registered before their dependents, as a container would
+    nodes = [make_node(i) for i in range(size)]
+    dependencies = [[] for _ in range(size)]
+    for dependent, dependence in synthetic_edges(shape, size):
+        dependencies[dependent].append(nodes[dependence])
+
+    elapsed = 0.0
+    for _ in range(loops):
+        graph = deps.DepGraph()
+        start = time.perf_counter()
+        for node, node_dependencies in zip(nodes, dependencies):
+            graph.add_node(node, node_dependencies)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def bench_add_nodes(loops: int, shape: str, size: int) -> float:
+    # the same entries as bench_add_node, registered as one batch
+    nodes = [make_node(i) for i in range(size)]
+    dependencies = [[] for _ in range(size)]
+    for dependent, dependence in synthetic_edges(shape, size):
+        dependencies[dependent].append(nodes[dependence])
+
+    elapsed = 0.0
+    for _ in range(loops):
+        graph = deps.DepGraph()
+        start = time.perf_counter()
+        graph.add_nodes(zip(nodes, dependencies))
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def bench_add_relationship(loops: int, shape: str, size: int) -> float:
+    nodes = [make_node(i) for i in range(size)]
+    edges = [(nodes[i].name, nodes[j].name) for i, j in synthetic_edges(shape, size)]
+
+    elapsed = 0.0
+    for _ in range(loops):
+        graph = deps.DepGraph()
+        for node in nodes:
+            graph.add_node(node)
+        start = time.perf_counter()
+        for dependent, dependence in edges:
+            graph.add_relationship(dependent, dependence)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def scan_dependencies(graph: deps.DepGraph, name: str):
+    node = graph.name_index[name]
+    return set(dc for dt, dc in graph.relationships if dt is node)
+
+
+def scan_dependents(graph: deps.DepGraph, name: str):
+    node = graph.name_index[name]
+    return set(dt for dt, dc in graph.relationships if dc is node)
+
+
+def bench_lookup(loops: int, shape: str, size: int, lookup) -> float:
+    graph = build_graph(shape, size)
+    names = random.Random(1).choices(list(graph.name_index), k=LOOKUPS)
+
+    start = time.perf_counter()
+    for _ in range(loops):
+        for name in names:
+            lookup(graph, name)
+    return time.perf_counter() - start
+
+
+def make_dependents(count: int, parameters: int = 5):
+    parameter_list = ", ".join(f"p{i}: int" for i in range(parameters))
+    namespace = {}
+    exec(f"def __init__(self, {parameter_list}): pass", namespace)
+    return [type(f"Dependent{i}", (), {"__init__": namespace["__init__"]}) for i in range(count)]
+
+
+def bench_extract_dependencies(loops: int, size: int, warm: bool) -> float:
+    dependents = make_dependents(min(size, 1000))
+    if warm:
+        for d in dependents:
+            deps.extract_dependencies(d)
+
+    elapsed = 0.0
+    for _ in range(loops):
+        if not warm:
+            deps.extract_dependencies.cache_clear()
+        start = time.perf_counter()
+        for d in dependents:
+            deps.extract_dependencies(d)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def import_command(statement: str):
+    directory = os.path.dirname(os.path.abspath(deps.__file__))
+    return [sys.executable, "-c", f"import sys; sys.path.insert(0, {directory!r}); {statement}"]
+
+
+def add_cmdline_args(cmd, args):
+    cmd.extend(("--shapes", *args.shapes))
+    cmd.extend(("--sizes", *map(str, args.sizes)))
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=add_cmdline_args)
+    runner.argparser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    runner.argparser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    args = runner.parse_args()
+
+    runner.bench_command("startup", import_command("pass"))
+    runner.bench_command("import_deps", import_command("import deps"))
+    for size in args.sizes:
+        for shape in args.shapes:
+            runner.bench_time_func(f"add_node[{shape}-{size}]", bench_add_node, shape, size)
+            runner.bench_time_func(f"add_nodes[{shape}-{size}]", bench_add_nodes, shape, size)
+            runner.bench_time_func(f"add_relationship[{shape}-{size}]", bench_add_relationship, shape, size)
+            runner.bench_time_func(
+                f"get_dependencies[{shape}-{size}]", bench_lookup, shape, size, deps.DepGraph.get_dependencies,
+                inner_loops=LOOKUPS,
+            )
+            runner.bench_time_func(
+                f"get_dependents[{shape}-{size}]", bench_lookup, shape, size, deps.DepGraph.get_dependents,
+                inner_loops=LOOKUPS,
+            )
+            if size <= SCAN_MAX_SIZE:
+                runner.bench_time_func(
+                    f"scan_dependencies[{shape}-{size}]", bench_lookup, shape, size, scan_dependencies,
+                    inner_loops=LOOKUPS,
+                )
+                runner.bench_time_func(
+                    f"scan_dependents[{shape}-{size}]", bench_lookup, shape, size, scan_dependents,
+                    inner_loops=LOOKUPS,
+                )
+        runner.bench_time_func(f"extract_dependencies[cold-{size}]", bench_extract_dependencies, size, False)
+        runner.bench_time_func(f"extract_dependencies[warm-{size}]", bench_extract_dependencies, size, True)
+
+
+if __name__ == "__main__":
+    main()
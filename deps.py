@@ -16,58 +16,422 @@ Goals/Todos:
 import typing
 import inspect
 import collections
+import itertools
 import types
+import array
+import threading
+import contextlib
+import contextvars
+import enum
+import weakref
+import keyword
+import abc
+import functools
+import operator
+import logging
+import time
+
+if typing.TYPE_CHECKING:
+    from concurrent.futures import Executor as _Executor
+else:
+    # concurrent.futures is only imported by ThreadPoolProvider, as it is slow to import
+    _Executor = typing.Any
 
 
 T = typing.TypeVar("T")
 
+logger = logging.getLogger(__name__)
+
 # move to utils
 def first(it, default=None, pred=None):
     return next((x for x in it if pred is None or pred(x)), default)
 
 
 # move to utils
-def record_init(self, *args, **kwargs):
-    slots = getattr(type(self), "__slots__")
-    for a, k in zip(args, slots):
-        setattr(self, k, a)
-        
-    for k, v in kwargs.items():
-        setattr(self, k, v)
+def bit_indexes(bits: int) -> typing.Iterator[int]:
+    """Positions of the set bits of a non-negative int, in increasing order"""
+    digits = bin(bits)[:1:-1]
+    i = digits.find("1")
+    while i != -1:
+        yield i
+        i = digits.find("1", i + 1)
+
 
 # move to utils
-def record_repr(self):
-    type_name = type(self).__name__
-    slots = getattr(type(self), "__slots__")
-    field_string = ", ".join(
-        k+"="+str(getattr(self, k))
-        for k in slots
-    )
+class FrozenRecordError(AttributeError):
+    def __init__(self, record, name: str):
+        super().__init__(f"Cannot assign or delete {name} of frozen record {type(record).__name__}")
+        self.name = name
+
+
+# move to utils
+def record_functions(name: str, source: str, namespace: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Callable]:
+    namespace = {"__record_setattr__": object.__setattr__, **namespace}
+    exec(source, namespace)
+    functions = {k: v for k, v in namespace.items() if isinstance(v, types.FunctionType)}
+    for k, f in functions.items():
+        f.__qualname__ = f"{name}.{k}"
+    return functions
+
+# move to utils
+def record_parameters(self_name: str, fields: typing.Sequence[str], defaults: typing.Mapping[str, typing.Any]) -> typing.List[str]:
+    parameters = [self_name]
+    keyword_only = False
+    for k in fields:
+        if k in defaults:
+            parameters.append(f"{k}=__record_defaults__[{k!r}]")
+        else:
+            if not keyword_only and len(parameters) > 1 and "=" in parameters[-1]:
+                keyword_only = True
+                parameters.append("*")
+            parameters.append(k)
+    return parameters
+
+# move to utils
+def record_init(name: str, fields: typing.Sequence[str], defaults: typing.Mapping[str, typing.Any], frozen: bool = False):
+    """
+    `__init__` assigning `fields` in order, generated for one record class.
+    Fields following one with a default value are keyword-only, so that required fields inherited
+    after defaulted ones stay required.
+    """
+    self_name = "self" if "self" not in fields else "__record_self__"
+    parameters = record_parameters(self_name, fields, defaults)
+    if frozen:
+        body = "".join(f"    __record_setattr__({self_name}, {k!r}, {k})\n" for k in fields)
+    else:
+        body = "".join(f"    {self_name}.{k} = {k}\n" for k in fields)
+    source = f"def __init__({', '.join(parameters)}):\n{body or '    pass'}\n"
+    return record_functions(name, source, {"__record_defaults__": defaults})["__init__"]
+
+# move to utils
+def record_value_functions(name: str, fields: typing.Sequence[str]) -> typing.Dict[str, typing.Callable]:
+    """
+    `__eq__` and `__hash__` comparing the fields of a frozen record, the hash being computed once
+    and kept in the `__record_hash__` slot, and `__setattr__`/`__delattr__` rejecting changes.
+    """
+    own = "".join(f"self.{k}, " for k in fields)
+    other = "".join(f"other.{k}, " for k in fields)
+    source = f"""\
+def __eq__(self, other):
+    if self is other:
+        return True
+    if type(other) is not type(self):
+        return NotImplemented
+    return hash(self) == hash(other) and ({own}) == ({other})
+
+def __hash__(self):
+    try:
+        return self.__record_hash__
+    except AttributeError:
+        value = hash(({own}))
+        __record_setattr__(self, "__record_hash__", value)
+        return value
+
+def __setattr__(self, name, value):
+    raise FrozenRecordError(self, name)
+
+def __delattr__(self, name):
+    raise FrozenRecordError(self, name)
+"""
+    return record_functions(name, source, {"FrozenRecordError": FrozenRecordError})
+
+# move to utils
+def record_compact_functions(name: str, fields: typing.Sequence[str], defaults: typing.Mapping[str, typing.Any]) -> typing.Dict[str, typing.Callable]:
+    """
+    `__new__` packing `fields` into the tuple of a compact record, and `__eq__`/`__ne__` comparing
+    records of the same type only: they do not return NotImplemented, which would let a plain tuple compare equal.
+    """
+    cls_name = "cls" if "cls" not in fields else "__record_cls__"
+    parameters = record_parameters(cls_name, fields, defaults)
+    values = "".join(f"{k}, " for k in fields)
+    source = f"""\
+def __new__({', '.join(parameters)}):
+    return __record_tuple_new__({cls_name}, ({values}))
+
+def __eq__(self, other):
+    return self is other or type(other) is type(self) and __record_tuple_eq__(self, other)
+
+def __ne__(self, other):
+    return not __eq__(self, other)
+"""
+    return record_functions(name, source, {
+        "__record_defaults__": defaults, "__record_tuple_new__": tuple.__new__, "__record_tuple_eq__": tuple.__eq__,
+    })
+
+# move to utils
+def record_conversion_functions(name: str, type_name: str, fields: typing.Sequence[str]) -> typing.Dict[str, typing.Callable]:
+    """
+    `__repr__` and `__record_values__` (the tuple of field values) of one record class,
+    with the fields spelled out instead of looked up by name on every call.
+    """
+    field_string = ", ".join(f"{k}={{self.{k}!s}}" for k in fields)
+    values = "".join(f"self.{k}, " for k in fields)
+    source = f"""\
+def __repr__(self):
     return f"{type_name}({field_string})"
-            
+
+def __record_values__(self):
+    return ({values})
+"""
+    return record_functions(name, source, {})
+
 # move to utils
-def record_type(name, bases, nmspc, **kwargs):
+def compact_record(cls, values: tuple):
+    return tuple.__new__(cls, values)
+
+# move to utils
+def record_reduce(self):
+    return compact_record, (type(self), tuple(self))
+
+# move to utils
+def frozen_record(cls, values: tuple):
+    return cls(**dict(zip(cls.__record_fields__, values)))
+
+# move to utils
+def frozen_record_reduce(self):
+    # rebuilt through the constructor: restoring slots would go through __setattr__,
+    # and the cached hash may not hold in another process (str hashes are randomized)
+    return frozen_record, (type(self), type(self).__record_values__(self))
+
+# move to utils
+def record_namespace(name, nmspc, bases=(), frozen: typing.Optional[bool] = None, compact: typing.Optional[bool] = None):
+    """
+    Turn annotated fields into slots, moving their default values out of the class namespace,
+    and generate the `__init__` of the record.
+    Fields are inherited from record bases: a plain value in the namespace overrides their default,
+    and a descriptor (e.g. a property) replaces them.
+    Frozen records (inherited from bases) cannot be changed after `__init__`, and compare and hash by value.
+    Compact records (inherited too) store their fields in a tuple, read through properties:
+    they are immutable and compare by value, but do not cache their hash.
+    """
+    if "__record_fields__" in nmspc:
+        # already processed, when record_type creates a class of RecordType
+        return nmspc
     annotations = nmspc.get("__annotations__", {})
     slots = list(annotations.keys())
-    nmspc.update(__slots__=slots, __init__=record_init, __repr__=record_repr)
+    defaults = {}
+    fields = {}
+    bases = types.resolve_bases(bases)
+    for base in reversed(bases):
+        defaults.update(getattr(base, "__record_defaults__", {}))
+        fields.update(dict.fromkeys(getattr(base, "__record_fields__", ())))
+    frozen_base = any(getattr(base, "__record_frozen__", False) for base in bases)
+    if compact is None:
+        compact = any(getattr(base, "__record_compact__", False) for base in bases)
+    if compact and (frozen or frozen_base):
+        raise TypeError(f"Record {name} cannot be both compact and frozen")
+    if frozen is None:
+        frozen = frozen_base
+    elif frozen_base and not frozen:
+        raise TypeError(f"Record {name} cannot unfreeze a frozen base")
+
+    for k in [k for k in fields if k in nmspc and k not in annotations]:
+        if hasattr(type(nmspc[k]), "__get__"):
+            del fields[k]
+            defaults.pop(k, None)
+        else:
+            defaults[k] = nmspc.pop(k)
+    defaults.update({k: nmspc.pop(k) for k in slots if k in nmspc})
+    fields.update(dict.fromkeys(slots))
+    logger.debug("record %s: fields %s, defaults %s, frozen %s", name, tuple(fields), defaults, frozen)
+
+    qualname = nmspc.get("__qualname__", name)
+    if compact:
+        nmspc.update(
+            {k: property(operator.itemgetter(i)) for i, k in enumerate(fields)},
+            __slots__=(), __record_fields__=tuple(fields), __record_defaults__=defaults,
+            __record_frozen__=False, __record_compact__=True,
+            __init__=object.__init__, __hash__=tuple.__hash__, __reduce__=record_reduce,
+            **record_conversion_functions(qualname, name, tuple(fields)),
+        )
+        nmspc.update(record_compact_functions(qualname, tuple(fields), defaults))
+        return nmspc
+    nmspc.update(
+        __slots__=slots, __record_fields__=tuple(fields), __record_defaults__=defaults,
+        __record_frozen__=frozen, __record_compact__=False,
+        __init__=record_init(qualname, tuple(fields), defaults, frozen),
+        **record_conversion_functions(qualname, name, tuple(fields)),
+    )
+    if frozen:
+        if not frozen_base:
+            slots.append("__record_hash__")
+        nmspc.update(record_value_functions(qualname, tuple(fields)), __reduce__=frozen_record_reduce)
+    return nmspc
+
+# move to utils
+def record_type(name, bases, nmspc, frozen: typing.Optional[bool] = None, compact: typing.Optional[bool] = None, **kwargs):
+    record_namespace(name, nmspc, bases, frozen, compact)
+    if nmspc["__record_compact__"] and not any(issubclass(b, tuple) for b in types.resolve_bases(bases)):
+        bases = (*bases, tuple)
     return types.new_class(name, bases, exec_body=lambda ns: ns.update(nmspc), kwds=kwargs)
 
 
 # move to utils
 class RecordType(type):
-    def __new__(cls, name, bases, nmspc, **kwargs):
-        print(cls, name, bases, nmspc, kwargs)
-        annotations = nmspc.get("__annotations__", {})
-        slots = list(annotations.keys())
-        nmspc.update(__slots__=slots, __init__=record_init, __repr__=record_repr)
+    def __new__(cls, name, bases, nmspc, frozen: typing.Optional[bool] = None, compact: typing.Optional[bool] = None, **kwargs):
+        record_namespace(name, nmspc, bases, frozen, compact)
+        if nmspc["__record_compact__"] and not any(issubclass(b, tuple) for b in bases):
+            bases = (*bases, tuple)
         return type.__new__(cls, name, bases, nmspc, **kwargs)
 
 
 # move to utils
 class RecordBase(metaclass=RecordType):
-    __init__ = record_init
-    __repr__ = record_repr
-    
+    pass
+
+
+# move to utils
+class WeakCache:
+    """
+    Memoize a function of one argument, keyed weakly on the argument.
+    An entry is recomputed when the stamp of its key changes, stamps being compared item by item by identity.
+    Arguments that cannot be weakly referenced or hashed are not cached.
+    """
+    CacheInfo = collections.namedtuple("CacheInfo", "hits misses currsize")
+
+    def __init__(self, function: typing.Callable, stamp: typing.Callable[[typing.Any], tuple] = lambda obj: ()):
+        self.function = function
+        self.stamp = stamp
+        self._entries = weakref.WeakKeyDictionary()
+        self.hits = self.misses = 0
+
+    def __call__(self, obj):
+        stamp = self.stamp(obj)
+        try:
+            cached_stamp, value = self._entries[obj]
+        except (KeyError, TypeError):
+            pass
+        else:
+            if all(a is b for a, b in zip(stamp, cached_stamp)):
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        value = self.function(obj)
+        try:
+            self._entries[obj] = (stamp, value)
+        except TypeError:
+            pass
+        return value
+
+    def cache_info(self) -> "WeakCache.CacheInfo":
+        return self.CacheInfo(self.hits, self.misses, len(self._entries))
+
+    def cache_clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+
+# move to utils
+def is_record(obj) -> bool:
+    return hasattr(type(obj), "__record_values__")
+
+# move to utils
+def to_tuple(record) -> tuple:
+    """Field values of a record, in field order"""
+    return type(record).__record_values__(record)
+
+# move to utils
+def to_dict(record, nested: bool = True) -> typing.Dict[str, typing.Any]:
+    """Fields of a record by name, records held in fields being converted too unless `nested` is false"""
+    values = type(record).__record_values__(record)
+    if nested:
+        values = [to_dict(v) if is_record(v) else v for v in values]
+    return dict(zip(type(record).__record_fields__, values))
+
+
+# move to utils
+def record_field_types(cls: type) -> typing.Dict[str, type]:
+    """Record classes annotated on the fields of a record class, generic aliases included"""
+    annotations = {}
+    for base in reversed(cls.__mro__):
+        annotations.update(base.__dict__.get("__annotations__", {}))
+    field_types = {}
+    for k in cls.__record_fields__:
+        t = annotations.get(k)
+        t = typing.get_origin(t) or t
+        if isinstance(t, type) and hasattr(t, "__record_values__"):
+            field_types[k] = t
+    return field_types
+
+record_field_types = WeakCache(record_field_types)
+
+# move to utils
+def from_dict(cls: typing.Type[T], data: typing.Mapping[str, typing.Any]) -> T:
+    """Record of class `cls` from a to_dict mapping, nested mappings being converted to the records annotated"""
+    field_types = record_field_types(cls)
+    if field_types:
+        data = {
+            k: from_dict(field_types[k], v) if k in field_types and isinstance(v, collections.abc.Mapping) else v
+            for k, v in data.items()
+        }
+    return cls(**data)
+
+
+# move to utils
+class LazyProxy:
+    """
+    Stand-in for the object returned by `factory`, which is only called on first use.
+    The target is then kept, and attribute access, calls and common operations are forwarded to it.
+    """
+    __slots__ = ("_lazy_factory", "_lazy_target", "_lazy_lock")
+
+    def __init__(self, factory: typing.Callable[[], typing.Any]):
+        object.__setattr__(self, "_lazy_factory", factory)
+        object.__setattr__(self, "_lazy_lock", threading.RLock())
+
+    def _lazy_resolve(self):
+        try:
+            return object.__getattribute__(self, "_lazy_target")
+        except AttributeError:
+            pass
+        # first use may happen concurrently in several threads: only one of them calls the factory
+        with object.__getattribute__(self, "_lazy_lock"):
+            try:
+                return object.__getattribute__(self, "_lazy_target")
+            except AttributeError:
+                target = object.__getattribute__(self, "_lazy_factory")()
+                object.__setattr__(self, "_lazy_target", target)
+                object.__delattr__(self, "_lazy_factory")
+                return target
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lazy_resolve(), name)
+
+    def __repr__(self):
+        # the factory is only deleted once the target is set, possibly by another thread meanwhile
+        try:
+            factory = object.__getattribute__(self, "_lazy_factory")
+        except AttributeError:
+            return repr(object.__getattribute__(self, "_lazy_target"))
+        return f"{type(self).__name__}({factory!r})"
+
+    __str__ = lambda self: str(self._lazy_resolve())
+    __bool__ = lambda self: bool(self._lazy_resolve())
+    __len__ = lambda self: len(self._lazy_resolve())
+    __iter__ = lambda self: iter(self._lazy_resolve())
+    __contains__ = lambda self, item: item in self._lazy_resolve()
+    __getitem__ = lambda self, key: self._lazy_resolve()[key]
+    __setitem__ = lambda self, key, value: self._lazy_resolve().__setitem__(key, value)
+    __delitem__ = lambda self, key: self._lazy_resolve().__delitem__(key)
+    __call__ = lambda self, *args, **kwargs: self._lazy_resolve()(*args, **kwargs)
+    __eq__ = lambda self, other: self._lazy_resolve() == other
+    __ne__ = lambda self, other: self._lazy_resolve() != other
+    __hash__ = lambda self: hash(self._lazy_resolve())
+    __enter__ = lambda self: self._lazy_resolve().__enter__()
+    __exit__ = lambda self, *exc_info: self._lazy_resolve().__exit__(*exc_info)
+
+
+# move to utils
+def resolve_lazy(obj):
+    """Target of a LazyProxy, built if needed, or `obj` itself"""
+    return obj._lazy_resolve() if type(obj) is LazyProxy else obj
 
 
 # move to utils
@@ -92,20 +456,73 @@ class delegate:
 
     
 
-class Dependency(typing.Generic[T], RecordBase):
+class Scope(enum.Enum):
+    """How long a provided instance is cached"""
+    SINGLETON = "singleton"
+    THREAD = "thread"
+    CONTEXT = "context"
+    TRANSIENT = "transient"
+
+
+class Dependency(typing.Generic[T], RecordBase, frozen=True):
     factory: typing.Callable[..., T]
     type: typing.Type[T]
+    scope: Scope = Scope.SINGLETON
+    # inject a LazyProxy, building the dependency on first use
+    lazy: bool = False
 
     def provide(self, *args, **kwargs) -> T:
         return self.factory(*args, **kwargs)
     
     
-class Node(typing.Generic[T], metaclass=RecordType):
+class Node(typing.Generic[T], metaclass=RecordType, frozen=True):
     name: str
     dependency_type: Dependency[T]
 
 
-# TODO: look into using algebraic graph impl.: dep = connect (vertex Dependency) (overlay [Dependency ...])
+class ProvisionError(RuntimeError):
+    def __init__(self, name: str):
+        super().__init__(f"Failed to provide {name}")
+        self.name = name
+
+
+class CyclicDependencyError(ValueError):
+    def __init__(self, path: typing.Sequence[str]):
+        super().__init__("Cyclic dependency: " + " -> ".join(path))
+        self.path = tuple(path)
+
+
+_PROTOCOL_INTERNALS = {
+    *vars(typing.Protocol), *vars(typing.Generic),
+    "__module__", "__qualname__", "__doc__", "__dict__", "__weakref__", "__annotations__", "__init__",
+    "__parameters__", "__orig_bases__", "__abstractmethods__", "__protocol_attrs__", "__non_callable_proto_members__",
+    "_is_protocol", "_is_runtime_protocol",
+}
+
+
+# move to utils
+def protocol_members(protocol: type) -> typing.Set[str]:
+    members = set()
+    for base in protocol.__mro__:
+        if getattr(base, "_is_protocol", False) and base is not typing.Protocol:
+            members.update(vars(base))
+            members.update(getattr(base, "__annotations__", {}))
+    return {m for m in members if m not in _PROTOCOL_INTERNALS and not m.startswith("_abc_")}
+
+
+# move to utils
+def satisfies(cls: type, target: type) -> bool:
+    """Whether `cls` is a (possibly virtual) subclass of `target`, or structurally implements it if it is a protocol"""
+    try:
+        return issubclass(cls, target)
+    except TypeError:
+        # protocol that is not runtime checkable, or has data members
+        if not getattr(target, "_is_protocol", False):
+            raise
+    annotated = set().union(*(getattr(base, "__annotations__", {}) for base in cls.__mro__))
+    return all(hasattr(cls, m) or m in annotated for m in protocol_members(target))
+
+
 class DepGraph:
     def __init__(self):
         self.type_index: typing.Dict[type, typing.Set[Node]] = collections.defaultdict(set)
@@ -115,70 +532,1598 @@ class DepGraph:
         self.relationships: typing.Set[typing.Tuple[Node, Node]] = set()
         # Invariant: set().union(*self.relationships.values()) == set(self.name_index.values())
 
+        # adjacency indexes over self.relationships, dependent -> dependencies and dependence -> dependents
+        self.dependencies_index: typing.Dict[Node, typing.Set[Node]] = collections.defaultdict(set)
+        self.dependents_index: typing.Dict[Node, typing.Set[Node]] = collections.defaultdict(set)
+        # Invariant: {(dt, dc) for dt, dcs in self.dependencies_index.items() for dc in dcs} == self.relationships
+
+        # topological position of every node, dependents before dependencies,
+        # maintained incrementally on edge insertion (Pearce-Kelly), and the current bounds of the positions
+        self._topological_order: typing.Dict[Node, int] = {}
+        self._first_position = self._last_position = 0
+
+        # reachability index: dense node ids, and per id the bitset of its transitive dependencies,
+        # None while stale (a valid bitset implies valid bitsets for all the node's dependencies)
+        self._node_ids: typing.Dict[Node, int] = {}
+        self._nodes: typing.List[Node] = []
+        self._reachable: typing.List[typing.Optional[int]] = []
+
+        # memoized find_by_type results; lookups by ABC (and protocol) may match any newly registered type
+        self._type_lookup_cache: typing.Dict[typing.Any, typing.FrozenSet[Node]] = {}
+        self._structural_lookups: typing.Set[type] = set()
+
+        # memoized resolution orders per root name, and the roots whose order goes through each node
+        self._resolution_cache: typing.Dict[str, typing.Tuple[Node, ...]] = {}
+        self._levels_cache: typing.Dict[str, typing.Tuple[typing.Tuple[Node, ...], ...]] = {}
+        self._cached_roots: typing.Dict[Node, typing.Set[str]] = collections.defaultdict(set)
+
+        # bumped on every change, for the caches of child graphs
+        self._version = 0
+
+    def _stamp(self):
+        return self._version
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name_index
+
+    def child(self) -> "ChildGraph":
+        """Overlay sharing this graph's nodes and edges, storing only its own additions and overrides"""
+        return ChildGraph(self)
+
+    def _invalidate(self, node: Node):
+        """Drop cached results for every root whose subgraph contains `node`"""
+        for root in self._cached_roots.pop(node, ()):
+            self._levels_cache.pop(root, None)
+            order = self._resolution_cache.pop(root, ())
+            for n in order:
+                if n != node:
+                    self._cached_roots[n].discard(root)
+
+    def _index_type(self, node: Node):
+        self._version += 1
+        t = node.dependency_type.type
+        self.type_index[t].add(node)
+        if isinstance(t, type):
+            for base in t.__mro__:
+                self._type_lookup_cache.pop(base, None)
+            # ABC/protocol lookups can match virtual or structural subclasses: extend those the new type satisfies
+            for target in self._structural_lookups:
+                cached = self._type_lookup_cache.get(target)
+                if cached is not None and satisfies(t, target):
+                    self._type_lookup_cache[target] = cached | {node}
+        else:
+            self._type_lookup_cache.pop(t, None)
+
+    def _index_node(self, node: Node):
+        if node not in self._node_ids:
+            # new nodes go first: they are more likely to be dependents than dependencies of existing nodes
+            self._first_position -= 1
+            self._topological_order[node] = self._first_position
+            self._node_ids[node] = len(self._nodes)
+            self._nodes.append(node)
+            self._reachable.append(0)
+
+    def _extend_closure(self, dependent: Node, dependence: Node):
+        """Mark stale the reachability bitsets a new dependent -> dependence edge may extend"""
+        ids = self._node_ids
+        bits = self._reachable[ids[dependent]]
+        if bits is not None and bits >> ids[dependence] & 1:
+            return
+        self._invalidate_closure([dependent])
+
+    def _invalidate_closure(self, nodes: typing.Iterable[Node]):
+        # the dependents of a stale node are stale already: the walk stops there
+        ids, reachable = self._node_ids, self._reachable
+        stack = list(nodes)
+        for node in stack:
+            reachable[ids[node]] = None
+        while stack:
+            for d in self.dependents_index.get(stack.pop(), ()):
+                if reachable[ids[d]] is not None:
+                    reachable[ids[d]] = None
+                    stack.append(d)
+
+    def _reachable_bits(self, node: Node) -> int:
+        """Bitset of the transitive dependencies of `node`, recomputing the stale ones it needs"""
+        ids, reachable = self._node_ids, self._reachable
+        stack = [node]
+        while stack:
+            n = stack[-1]
+            if reachable[ids[n]] is not None:
+                stack.pop()
+                continue
+            dependencies = self.dependencies_index.get(n, ())
+            stale = [d for d in dependencies if reachable[ids[d]] is None]
+            if stale:
+                stack.extend(stale)
+                continue
+            bits = 0
+            for d in dependencies:
+                bits |= reachable[ids[d]] | 1 << ids[d]
+            reachable[ids[n]] = bits
+            stack.pop()
+        return reachable[ids[node]]
+
+    def _reorder(self, dependent: Node, dependence: Node):
+        """
+        Restore the topological order before inserting dependent -> dependence,
+        raising CyclicDependencyError if the edge would close a cycle.
+        Only the nodes positioned between both endpoints are visited.
+        """
+        position = self._topological_order
+        lower, upper = position[dependence], position[dependent]
+        if lower > upper:
+            return
+        if dependent == dependence:
+            raise CyclicDependencyError([dependent.name, dependence.name])
+        # a node without dependencies can always move last, and one without dependents first:
+        # that covers dependencies registered along with their dependent, whatever the registration order
+        if not self.dependencies_index.get(dependence):
+            self._last_position += 1
+            position[dependence] = self._last_position
+            return
+        if not self.dependents_index.get(dependent):
+            self._first_position -= 1
+            position[dependent] = self._first_position
+            return
+
+        # nodes reachable from dependence, positioned before dependent
+        forward = {dependence: None}
+        stack = [dependence]
+        while stack:
+            node = stack.pop()
+            for d in self.dependencies_index.get(node, ()):
+                if d == dependent:
+                    path = [dependent.name]
+                    while node is not None:
+                        path.append(node.name)
+                        node = forward[node]
+                    path[1:] = reversed(path[1:])
+                    path.append(dependent.name)
+                    raise CyclicDependencyError(path)
+                if d not in forward and position[d] < upper:
+                    forward[d] = node
+                    stack.append(d)
+
+        # nodes reaching dependent, positioned after dependence
+        backward = {dependent}
+        stack = [dependent]
+        while stack:
+            node = stack.pop()
+            for d in self.dependents_index.get(node, ()):
+                if d not in backward and position[d] > lower:
+                    backward.add(d)
+                    stack.append(d)
+
+        affected = sorted(backward, key=position.__getitem__) + sorted(forward, key=position.__getitem__)
+        for node, p in zip(affected, sorted(position[n] for n in affected)):
+            position[node] = p
+
+    def _add_edge(self, dependent: Node, dependence: Node):
+        edge = (dependent, dependence)
+        if edge in self.relationships:
+            return
+        self._index_node(dependent)
+        self._index_node(dependence)
+        self._reorder(dependent, dependence)
+        self._invalidate(dependent)
+        self._extend_closure(dependent, dependence)
+        self._version += 1
+        self.relationships.add(edge)
+        self.dependencies_index[dependent].add(dependence)
+        self.dependents_index[dependence].add(dependent)
+
     def add_node(self, dep: Node, dependencies=None):
         if dep.name not in self.name_index:
-            self.type_index[dep.dependency_type.type].add(dep)
+            self._index_type(dep)
             self.name_index[dep.name] = dep
+            self._index_node(dep)
         else:
             # Probably should log something, or return some special value
             ...
 
         if dependencies:
+            # edges go between the registered nodes, as in add_nodes
+            dep = self.name_index[dep.name]
             for d in dependencies:
                 self.add_node(d)
-                self.relationships.add(
-                    (dep, d)
-                )
+                self._add_edge(dep, self.name_index[d.name])
+
+    def add_nodes(self, entries: typing.Iterable[typing.Tuple[Node, typing.Optional[typing.Iterable[Node]]]]):
+        """
+        Register many (node, dependencies) entries in one pass.
+        Nodes are deduplicated by name, already registered nodes taking precedence,
+        and the resulting graph is validated once: on a cycle, CyclicDependencyError is raised
+        and the graph is left unchanged.
+        """
+        added: typing.Dict[str, Node] = {}
+
+        def canonical(node: Node) -> Node:
+            try:
+                return self.name_index[node.name]
+            except KeyError:
+                return added.setdefault(node.name, node)
+
+        edges = []
+        for node, dependencies in entries:
+            dependent = canonical(node)
+            for d in dependencies or ():
+                edges.append((dependent, canonical(d)))
+        if all(dependent.name in added for dependent, _ in edges):
+            self._prepend_batch(added, edges)
+            return
+        edges = set(edges).difference(self.relationships)
+
+        new_dependencies = collections.defaultdict(set)
+        new_dependents = collections.defaultdict(set)
+        for dependent, dependence in edges:
+            new_dependencies[dependent].add(dependence)
+            new_dependents[dependence].add(dependent)
+
+        new_nodes = [n for n in added.values() if n not in self._node_ids]
+        if len(edges) * 8 <= len(self._nodes):
+            # a small batch on a large graph: repairing the order edge by edge only visits the affected nodes
+            self._add_batch(added, edges)
+            return
+        order = self._topological_sort(
+            [*self._nodes, *new_nodes],
+            lambda n: itertools.chain(self.dependencies_index.get(n, ()), new_dependencies.get(n, ())),
+            lambda n: itertools.chain(self.dependents_index.get(n, ()), new_dependents.get(n, ())),
+        )
+
+        # commit
+        for name, node in added.items():
+            self._index_type(node)
+            self.name_index[name] = node
+        first_id = len(self._nodes)
+        self._node_ids.update(zip(new_nodes, itertools.count(first_id)))
+        self._nodes.extend(new_nodes)
+        self._reachable.extend([0] * len(new_nodes))
+        self._topological_order = dict(zip(order, itertools.count()))
+        self._first_position, self._last_position = 0, len(order) - 1
+
+        for dependent in new_dependencies:
+            self._invalidate(dependent)
+        self._version += 1
+        self.relationships.update(edges)
+        for dependent, dependencies in new_dependencies.items():
+            self.dependencies_index[dependent].update(dependencies)
+        for dependence, dependents in new_dependents.items():
+            self.dependents_index[dependence].update(dependents)
+        self._invalidate_closure(new_dependencies.keys())
+
+    def _prepend_batch(self, added: typing.Dict[str, Node], edges: typing.List[typing.Tuple[Node, Node]]):
+        """
+        Register a batch in which only new nodes gain dependencies: no cycle goes through the registered nodes,
+        and the new nodes all go before them, in the order they are listed when that is dependencies first
+        or dependents first, else sorted among themselves
+        """
+        # new nodes are compared by their rank in the batch, as names hash faster than nodes
+        rank = {name: i for i, name in enumerate(added)}
+        inner = [(rank[dependent.name], rank[dependence.name]) for dependent, dependence in edges if dependence.name in rank]
+        nodes = list(added.values())
+        if all(i > j for i, j in inner):
+            order = nodes[::-1]
+        elif all(i < j for i, j in inner):
+            order = nodes
+        else:
+            dependencies = collections.defaultdict(list)
+            dependents = collections.defaultdict(list)
+            for i, j in inner:
+                dependencies[nodes[i]].append(nodes[j])
+                dependents[nodes[j]].append(nodes[i])
+            order = self._topological_sort(nodes, lambda n: dependencies.get(n, ()), lambda n: dependents.get(n, ()))
+
+        # commit
+        for name, node in added.items():
+            self._index_type(node)
+            self.name_index[name] = node
+        self._node_ids.update(zip(nodes, itertools.count(len(self._nodes))))
+        self._nodes.extend(nodes)
+        # the new nodes gaining dependencies are the only stale ones: registered nodes do not reach new nodes
+        stale = {dependent.name for dependent, _ in edges}
+        self._reachable.extend(None if name in stale else 0 for name in added)
+        self._first_position -= len(order)
+        self._topological_order.update(zip(order, itertools.count(self._first_position)))
+        self._version += 1
+        self.relationships.update(edges)
+        for dependent, dependence in edges:
+            self.dependencies_index[dependent].add(dependence)
+            self.dependents_index[dependence].add(dependent)
+
+    def _add_batch(self, added: typing.Dict[str, Node], edges: typing.Iterable[typing.Tuple[Node, Node]]):
+        """Insert edges one at a time, undoing the whole batch on a cycle"""
+        first_id = len(self._nodes)
+        for name, node in added.items():
+            self._index_type(node)
+            self.name_index[name] = node
+            self._index_node(node)
+
+        inserted = []
+        try:
+            for dependent, dependence in edges:
+                self._add_edge(dependent, dependence)
+                inserted.append((dependent, dependence))
+        except CyclicDependencyError:
+            # the order stays valid without the edges; the bitsets they extended are marked stale first
+            self._invalidate_closure(dependent for dependent, _ in inserted)
+            self.relationships.difference_update(inserted)
+            for dependent, dependence in inserted:
+                self.dependencies_index[dependent].discard(dependence)
+                self.dependents_index[dependence].discard(dependent)
+            for name, node in added.items():
+                del self.name_index[name]
+                self.type_index[node.dependency_type.type].discard(node)
+                del self._topological_order[node]
+                del self._node_ids[node]
+            del self._nodes[first_id:]
+            del self._reachable[first_id:]
+            raise
+
+    @staticmethod
+    def _topological_sort(nodes, dependencies, dependents) -> typing.List[Node]:
+        """Kahn's algorithm, dependents before dependencies"""
+        pending = {n: sum(1 for _ in dependents(n)) for n in nodes}
+        ready = [n for n, count in pending.items() if not count]
+        order = []
+        while ready:
+            node = ready.pop()
+            order.append(node)
+            for d in dependencies(node):
+                pending[d] -= 1
+                if not pending[d]:
+                    ready.append(d)
+
+        if len(order) < len(pending):
+            # every node left over still has a left over dependent: walk them back until one repeats
+            node = next(n for n, count in pending.items() if count)
+            path = []
+            seen = {}
+            while node not in seen:
+                seen[node] = len(path)
+                path.append(node)
+                node = next(d for d in dependents(node) if pending[d])
+            cycle = path[seen[node]:][::-1]
+            raise CyclicDependencyError([n.name for n in (*cycle, cycle[0])])
+        return order
 
     def add_dependencies(self, name: str, dependencies: typing.Set[Node]):
         node = self.name_index[name]
         for d in dependencies:
-            self.relationships.add(
-                (node, d)
-            )
+            self._add_edge(node, d)
 
     def add_relationship(self, dependent: str, dependence: str):
         assert dependent in self.name_index
         assert dependence in self.name_index
-        self.relationships.add((self.name_index[dependent], self.name_index[dependence]))
+        self._add_edge(self.name_index[dependent], self.name_index[dependence])
 
     def get_by_name(self, name: str):
         return self.name_index[name]
 
     def get_dependents(self, name: str):
         node = self.name_index[name]
-        dependents = set(
-            dt
-            for dt, dc in self.relationships
-            if dc is node
-        )
-        return dependents
+        return set(self.dependents_index.get(node, ()))
+
+    def find_by_type(self, cls) -> typing.FrozenSet[Node]:
+        """
+        Nodes registered for `cls`, or for any subclass of it, or for any class implementing it if it is a protocol.
+        Memoized per type; registering a node only invalidates or extends the lookups it can match.
+        """
+        try:
+            return self._type_lookup_cache[cls]
+        except KeyError:
+            pass
+
+        nodes = set(self.type_index.get(cls, ()))
+        if isinstance(cls, type):
+            for t, registered in self.type_index.items():
+                if t is not cls and isinstance(t, type) and satisfies(t, cls):
+                    nodes.update(registered)
+            if isinstance(cls, abc.ABCMeta):
+                self._structural_lookups.add(cls)
+
+        nodes = frozenset(nodes)
+        self._type_lookup_cache[cls] = nodes
+        return nodes
 
     def get_dependencies(self, name: str):
         node = self.name_index[name]
-        dependencies = set(
-            dc
-            for dt, dc in self.relationships
-            if dt is node
-        )
-        return dependencies
+        return set(self.dependencies_index.get(node, ()))
+
+    def freeze(self) -> "FrozenDepGraph":
+        """Read-only snapshot of the graph in compressed sparse row form"""
+        return FrozenDepGraph(self)
+
+    def depends_on(self, dependent: str, dependence: str) -> bool:
+        """Whether `dependent` transitively depends on `dependence`"""
+        v = self._node_ids[self.name_index[dependence]]
+        return bool(self._reachable_bits(self.name_index[dependent]) >> v & 1)
+
+    def transitive_dependencies(self, name: str) -> typing.Set[Node]:
+        reachable = self._reachable_bits(self.name_index[name])
+        return set(map(self._nodes.__getitem__, bit_indexes(reachable)))
+
+    def resolution_order(self, name: str) -> typing.Tuple[Node, ...]:
+        """
+        Nodes of the subgraph rooted at `name`, dependencies first, ending with the root itself.
+        Memoized per root; adding an edge only invalidates the roots whose subgraph contains its dependent.
+        """
+        try:
+            return self._resolution_cache[name]
+        except KeyError:
+            pass
+
+        root = self.name_index[name]
+        order = []
+        visited = {root}
+        stack = [(root, iter(self.dependencies_index.get(root, ())))]
+        while stack:
+            node, dependencies = stack[-1]
+            for d in dependencies:
+                if d not in visited:
+                    visited.add(d)
+                    stack.append((d, iter(self.dependencies_index.get(d, ()))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+
+        order = tuple(order)
+        self._resolution_cache[name] = order
+        for node in order:
+            self._cached_roots[node].add(name)
+        return order
+
+    def resolution_levels(self, name: str) -> typing.Tuple[typing.Tuple[Node, ...], ...]:
+        """
+        Partition the subgraph rooted at `name` in levels (Kahn's algorithm):
+        every node of a level only depends on nodes of previous levels, so a level can be built concurrently
+        once the previous ones are. Cached and invalidated along with resolution_order.
+        """
+        try:
+            return self._levels_cache[name]
+        except KeyError:
+            pass
+
+        order = self.resolution_order(name)
+        subgraph = set(order)
+        pending = {n: len(self.dependencies_index.get(n, ())) for n in order}
+        level = [n for n in order if not pending[n]]
+        levels = []
+        while level:
+            levels.append(tuple(level))
+            next_level = []
+            for node in level:
+                for d in self.dependents_index.get(node, ()):
+                    if d in subgraph:
+                        pending[d] -= 1
+                        if not pending[d]:
+                            next_level.append(d)
+            level = next_level
+
+        levels = tuple(levels)
+        self._levels_cache[name] = levels
+        return levels
     
 
+class ChildGraph(DepGraph):
+    """
+    Copy-on-write overlay of a parent graph: lookups fall through to the parent,
+    and only the nodes and edges added to the child (and overrides of parent nodes) are stored.
+    Parent edges are followed by name, so they reach the child's overrides.
+    Derived results (resolution orders, levels, reachability) are computed over the combined view
+    and cached until the child or one of its ancestors changes.
+    """
+    def __init__(self, parent: DepGraph):
+        super().__init__()
+        self.parent = parent
+        # names whose parent dependencies are hidden by an override
+        self._masked: typing.Set[str] = set()
+        # own edges, by name
+        self._own_dependencies: typing.Dict[str, typing.Set[str]] = collections.defaultdict(set)
+        self._own_dependents: typing.Dict[str, typing.Set[str]] = collections.defaultdict(set)
+        self._derived_cache: typing.Dict[typing.Tuple[str, str], typing.Any] = {}
+        self._derived_stamp = None
+
+    def _stamp(self):
+        return self._version, self.parent._stamp()
+
+    def _cached(self, kind: str, name: str, compute: typing.Callable[[str], typing.Any]):
+        stamp = self._stamp()
+        if stamp != self._derived_stamp:
+            self._derived_cache.clear()
+            self._derived_stamp = stamp
+        try:
+            return self._derived_cache[kind, name]
+        except KeyError:
+            value = self._derived_cache[kind, name] = compute(name)
+            return value
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name_index or name in self.parent
+
+    def _resolve(self, node: Node) -> Node:
+        return self.name_index.get(node.name, node)
+
+    def _add_edge(self, dependent: Node, dependence: Node):
+        if dependence.name in self._own_dependencies[dependent.name]:
+            return
+        if self._reaches(dependence.name, dependent.name):
+            path = [dependent.name, dependence.name]
+            while path[-1] != dependent.name:
+                path.append(next(
+                    d.name for d in self.get_dependencies(path[-1]) if self._reaches(d.name, dependent.name)
+                ))
+            raise CyclicDependencyError(path)
+        fresh = self._derived_stamp == self._stamp()
+        self._version += 1
+        if fresh:
+            self._derived_stamp = self._stamp()
+            self._drop_derived(dependent.name)
+        self.relationships.add((dependent, dependence))
+        self._own_dependencies[dependent.name].add(dependence.name)
+        self._own_dependents[dependence.name].add(dependent.name)
+
+    def _drop_derived(self, name: str):
+        """Drop the cached results of the roots whose subgraph contains `name`"""
+        roots = {name}
+        if self.get_dependents(name):
+            roots.update(
+                root for kind, root in self._derived_cache
+                if kind == "order" and any(n.name == name for n in self._derived_cache[kind, root])
+            )
+        for key in [key for key in self._derived_cache if key[1] in roots]:
+            del self._derived_cache[key]
+
+    def _reaches(self, source: str, target: str) -> bool:
+        if source == target:
+            return True
+        if not self.get_dependencies(source) or not self.get_dependents(target):
+            return False
+        if self._masked:
+            # overrides hide parent edges that the parent's reachability still follows
+            return any(n.name == target for n in self.resolution_order(source))
+
+        # child graphs hold few own edges: a path either stays in the parent,
+        # or goes through own edges, joined by paths in the parent
+        parent = self.parent
+        tails = [name for name, dependencies in self._own_dependencies.items() if dependencies]
+        visited = {source}
+        stack = [source]
+        while stack:
+            name = stack.pop()
+            in_parent = name in parent
+            if in_parent and target in parent and parent.depends_on(name, target):
+                return True
+            for tail in tails:
+                if tail == name or in_parent and tail in parent and parent.depends_on(name, tail):
+                    for d in self._own_dependencies[tail]:
+                        if d == target:
+                            return True
+                        if d not in visited:
+                            visited.add(d)
+                            stack.append(d)
+        return False
+
+    def add_node(self, dep: Node, dependencies=None):
+        if dep.name not in self:
+            fresh = self._derived_stamp == self._stamp()
+            self._index_type(dep)
+            self.name_index[dep.name] = dep
+            if fresh:
+                # a node without edges is in no cached result
+                self._derived_stamp = self._stamp()
+
+        if dependencies:
+            for d in dependencies:
+                self.add_node(d)
+                self._add_edge(dep, d)
+
+    def add_nodes(self, entries: typing.Iterable[typing.Tuple[Node, typing.Optional[typing.Iterable[Node]]]]):
+        for node, dependencies in entries:
+            self.add_node(node, dependencies)
+
+    def override(self, node: Node, dependencies: typing.Iterable[Node] = ()):
+        """Replace the node registered under `node.name` in the parent, along with its dependencies"""
+        old = self.name_index.pop(node.name, None)
+        if old is not None:
+            self.type_index[old.dependency_type.type].discard(old)
+            self._type_lookup_cache.clear()
+        for d in self._own_dependencies.pop(node.name, ()):
+            self._own_dependents[d].discard(node.name)
+        self.relationships = {(dt, dc) for dt, dc in self.relationships if dt.name != node.name}
+        if node.name in self.parent:
+            self._masked.add(node.name)
+        self._index_type(node)
+        self.name_index[node.name] = node
+        self.add_node(node, dependencies)
+
+    def add_dependencies(self, name: str, dependencies: typing.Set[Node]):
+        node = self.get_by_name(name)
+        for d in dependencies:
+            self._add_edge(node, d)
+
+    def add_relationship(self, dependent: str, dependence: str):
+        self._add_edge(self.get_by_name(dependent), self.get_by_name(dependence))
+
+    def get_by_name(self, name: str):
+        try:
+            return self.name_index[name]
+        except KeyError:
+            return self.parent.get_by_name(name)
+
+    def get_dependencies(self, name: str):
+        self.get_by_name(name)
+        dependencies = {self.get_by_name(d) for d in self._own_dependencies.get(name, ())}
+        if name not in self._masked and name in self.parent:
+            dependencies.update(map(self._resolve, self.parent.get_dependencies(name)))
+        return dependencies
+
+    def get_dependents(self, name: str):
+        self.get_by_name(name)
+        dependents = {self.get_by_name(d) for d in self._own_dependents.get(name, ())}
+        if name in self.parent:
+            dependents.update(
+                self._resolve(d) for d in self.parent.get_dependents(name)
+                if d.name not in self._masked
+            )
+        return dependents
+
+    def find_by_type(self, cls) -> typing.FrozenSet[Node]:
+        inherited = (n for n in self.parent.find_by_type(cls) if n.name not in self.name_index)
+        return super().find_by_type(cls).union(inherited)
+
+    def freeze(self) -> "FrozenDepGraph":
+        return self.flatten().freeze()
+
+    def flatten(self) -> DepGraph:
+        """Standalone copy of the combined graph"""
+        names = set(self.name_index)
+        graph = self.parent
+        while isinstance(graph, ChildGraph):
+            names.update(graph.name_index)
+            graph = graph.parent
+        names.update(graph.name_index)
+
+        flat = DepGraph()
+        flat.add_nodes((self.get_by_name(name), self.get_dependencies(name)) for name in names)
+        return flat
+
+    def depends_on(self, dependent: str, dependence: str) -> bool:
+        return dependent != dependence and self.get_by_name(dependence) in self.resolution_order(dependent)
+
+    def transitive_dependencies(self, name: str) -> typing.Set[Node]:
+        return set(self.resolution_order(name)[:-1])
+
+    def resolution_order(self, name: str) -> typing.Tuple[Node, ...]:
+        return self._cached("order", name, self._resolution_order)
+
+    def _resolution_order(self, name: str) -> typing.Tuple[Node, ...]:
+        root = self.get_by_name(name)
+        order = []
+        visited = {root.name}
+        stack = [(root, iter(self.get_dependencies(name)))]
+        while stack:
+            node, dependencies = stack[-1]
+            for d in dependencies:
+                if d.name not in visited:
+                    visited.add(d.name)
+                    stack.append((d, iter(self.get_dependencies(d.name))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        return tuple(order)
+
+    def resolution_levels(self, name: str) -> typing.Tuple[typing.Tuple[Node, ...], ...]:
+        return self._cached("levels", name, self._resolution_levels)
+
+    def _resolution_levels(self, name: str) -> typing.Tuple[typing.Tuple[Node, ...], ...]:
+        order = self.resolution_order(name)
+        subgraph = set(order)
+        pending = {n: len(self.get_dependencies(n.name)) for n in order}
+        level = [n for n in order if not pending[n]]
+        levels = []
+        while level:
+            levels.append(tuple(level))
+            next_level = []
+            for node in level:
+                for d in self.get_dependents(node.name):
+                    if d in subgraph:
+                        pending[d] -= 1
+                        if not pending[d]:
+                            next_level.append(d)
+            level = next_level
+        return tuple(levels)
+
+
+def _compressed_rows(rows: typing.Iterable[typing.Iterable[int]]) -> typing.Tuple[array.array, array.array]:
+    offsets = array.array("i", [0])
+    targets = array.array("i")
+    for row in rows:
+        targets.extend(row)
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+class FrozenDepGraph:
+    """
+    Immutable DepGraph snapshot: nodes get dense integer ids,
+    and edges are stored as compressed sparse rows of ids in both directions.
+    """
+    __slots__ = ("nodes", "name_index", "_dependency_offsets", "_dependencies", "_dependent_offsets", "_dependents")
+
+    def __init__(self, graph: DepGraph):
+        ids = graph._node_ids
+        self.nodes: typing.Tuple[Node, ...] = tuple(graph._nodes)
+        self.name_index: typing.Mapping[str, int] = types.MappingProxyType({
+            name: ids[node]
+            for name, node in graph.name_index.items()
+        })
+        self._dependency_offsets, self._dependencies = _compressed_rows(
+            sorted(ids[d] for d in graph.dependencies_index.get(node, ()))
+            for node in self.nodes
+        )
+        self._dependent_offsets, self._dependents = _compressed_rows(
+            sorted(ids[d] for d in graph.dependents_index.get(node, ()))
+            for node in self.nodes
+        )
+
+    def dependency_ids(self, i: int) -> array.array:
+        return self._dependencies[self._dependency_offsets[i]:self._dependency_offsets[i + 1]]
+
+    def dependent_ids(self, i: int) -> array.array:
+        return self._dependents[self._dependent_offsets[i]:self._dependent_offsets[i + 1]]
+
+    def get_by_name(self, name: str):
+        return self.nodes[self.name_index[name]]
+
+    def get_dependents(self, name: str):
+        return set(map(self.nodes.__getitem__, self.dependent_ids(self.name_index[name])))
+
+    def get_dependencies(self, name: str):
+        return set(map(self.nodes.__getitem__, self.dependency_ids(self.name_index[name])))
+
+
+class GraphExpression:
+    """
+    Algebraic graph: built from vertices with overlay (union of two graphs) and connect
+    (union, plus an edge from every vertex on the left to every vertex on the right, the left depending on the right),
+    each composition taking O(1).
+    The expression is folded into a DepGraph when first queried, and the result is cached;
+    it should be treated as read-only.
+
+        connect(vertex(service), overlay(vertex(database), vertex(cache)))
+    """
+    __slots__ = ("_folded",)
+
+    def __init__(self):
+        self._folded: typing.Optional[DepGraph] = None
+
+    def __add__(self, other: "GraphExpression") -> "GraphExpression":
+        return Overlay(self, other)
+
+    def __mul__(self, other: "GraphExpression") -> "GraphExpression":
+        return Connect(self, other)
+
+    def fold(self) -> DepGraph:
+        if self._folded is None:
+            self._folded = _fold(self)
+        return self._folded
+
+    def get_by_name(self, name: str) -> Node:
+        return self.fold().get_by_name(name)
+
+    def get_dependencies(self, name: str) -> typing.Set[Node]:
+        return self.fold().get_dependencies(name)
+
+    def get_dependents(self, name: str) -> typing.Set[Node]:
+        return self.fold().get_dependents(name)
+
+    def resolution_order(self, name: str) -> typing.Tuple[Node, ...]:
+        return self.fold().resolution_order(name)
+
+
+class Empty(GraphExpression):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Empty()"
+
+
+class Vertex(GraphExpression):
+    __slots__ = ("node",)
+
+    def __init__(self, node: Node):
+        super().__init__()
+        self.node = node
+
+    def __repr__(self):
+        return f"Vertex({self.node.name})"
+
+
+class Overlay(GraphExpression):
+    __slots__ = ("left", "right")
+
+    def __init__(self, left: GraphExpression, right: GraphExpression):
+        super().__init__()
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return f"Overlay({self.left!r}, {self.right!r})"
+
+
+class Connect(Overlay):
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"Connect({self.left!r}, {self.right!r})"
+
+
+def empty() -> GraphExpression:
+    return Empty()
+
+
+def vertex(node: Node) -> GraphExpression:
+    return Vertex(node)
+
+
+def vertices(nodes: typing.Iterable[Node]) -> GraphExpression:
+    return overlay(*map(Vertex, nodes))
+
+
+def overlay(*graphs: GraphExpression) -> GraphExpression:
+    return functools.reduce(Overlay, graphs) if graphs else Empty()
+
+
+def connect(*graphs: GraphExpression) -> GraphExpression:
+    return functools.reduce(Connect, graphs) if graphs else Empty()
+
+
+def _merge_vertices(left: typing.Dict[str, Node], right: typing.Dict[str, Node], shared: typing.Set[int]) -> typing.Dict[str, Node]:
+    # merge the smaller side into the larger one, the left taking precedence as in DepGraph.add_nodes;
+    # the vertices of shared subexpressions are copied rather than updated
+    if len(left) >= len(right):
+        if id(left) in shared:
+            left = dict(left)
+        for name, node in right.items():
+            left.setdefault(name, node)
+        return left
+    if id(right) in shared:
+        right = dict(right)
+    right.update(left)
+    return right
+
+
+def _fold(expression: GraphExpression) -> DepGraph:
+    """
+    Evaluate an expression into a DepGraph, without recursion.
+    Vertex sets are only collected for the operands of a connect, and cached subexpressions are reused.
+    Subexpressions appearing several times are evaluated once.
+    """
+    # how many times each subexpression appears
+    uses = collections.Counter()
+    stack = [expression]
+    while stack:
+        e = stack.pop()
+        uses[id(e)] += 1
+        if uses[id(e)] == 1 and e._folded is None and isinstance(e, Overlay):
+            stack.append(e.right)
+            stack.append(e.left)
+
+    entries = []
+    results: typing.List[typing.Optional[typing.Dict[str, Node]]] = []
+    # vertices of the subexpressions appearing several times, by id
+    evaluated_shared: typing.Dict[int, typing.Dict[str, Node]] = {}
+    shared: typing.Set[int] = set()
+    # (expression, whether its vertices are needed, whether its operands were evaluated)
+    stack = [(expression, False, False)]
+    while stack:
+        e, needed, evaluated = stack.pop()
+        if id(e) in evaluated_shared:
+            results.append(evaluated_shared[id(e)])
+            continue
+        if uses[id(e)] > 1:
+            needed = True
+
+        if e._folded is not None:
+            entries.extend((node, e._folded.get_dependencies(name)) for name, node in e._folded.name_index.items())
+            result = dict(e._folded.name_index) if needed else None
+        elif type(e) is Vertex:
+            entries.append((e.node, ()))
+            result = {e.node.name: e.node} if needed else None
+        elif type(e) is Empty:
+            result = {} if needed else None
+        elif not evaluated:
+            operands_needed = needed or type(e) is Connect
+            stack.append((e, needed, True))
+            stack.append((e.right, operands_needed, False))
+            stack.append((e.left, operands_needed, False))
+            continue
+        else:
+            right = results.pop()
+            left = results.pop()
+            if type(e) is Connect:
+                dependencies = tuple(right.values())
+                entries.extend((node, dependencies) for node in left.values())
+            result = _merge_vertices(left, right, shared) if needed else None
+
+        if uses[id(e)] > 1:
+            evaluated_shared[id(e)] = result
+            shared.add(id(result))
+        results.append(result)
+
+    graph = DepGraph()
+    graph.add_nodes(entries)
+    return graph
+
+
+class ForwardDependency(Dependency[T]):
+    """
+    Dependency of a parameter annotated with a string or forward reference,
+    whose type and factory are resolved from the owner's type hints when first needed.
+    The owner is weakly referenced when possible, so that caches keyed on it can release it.
+    """
+    owner_ref: typing.Callable[[], typing.Callable]
+    parameter: str
+
+    @classmethod
+    def of(cls, owner: typing.Callable, parameter: str) -> "ForwardDependency":
+        try:
+            owner_ref = weakref.ref(owner)
+        except TypeError:
+            owner_ref = lambda: owner
+        return cls(owner_ref=owner_ref, parameter=parameter)
+
+    @property
+    def owner(self) -> typing.Callable:
+        return self.owner_ref()
+
+    def _resolved(self) -> Dependency[T]:
+        try:
+            return _resolved_dependencies(self.owner)[self.parameter]
+        except KeyError:
+            raise NameError(f"Cannot resolve the annotation of {self.parameter}") from None
+
+    @property
+    def type(self) -> typing.Type[T]:
+        return self._resolved().type
+
+    @property
+    def factory(self) -> typing.Callable[..., T]:
+        return self._resolved().factory
+
+
+def _resolve_annotation(target: typing.Callable, annotation):
+    # evaluated alone, so that an unresolvable annotation does not hide the others
+    hints = types.SimpleNamespace(
+        __annotations__={"annotation": annotation},
+        __globals__=getattr(inspect.unwrap(target), "__globals__", {}),
+    )
+    return typing.get_type_hints(hints)["annotation"]
+
+
+def _resolved_dependencies(dependent: typing.Callable) -> typing.Dict[str, Dependency]:
+    """Dependencies of the parameters whose annotation resolves; the others are left out"""
+    target = dependent.__init__ if isinstance(dependent, type) else dependent
+    deps: typing.Dict[str, Dependency] = {}
+    for p_name, p in inspect.signature(dependent).parameters.items():
+        annotation = p.annotation
+        if isinstance(annotation, (str, typing.ForwardRef)):
+            try:
+                annotation = _resolve_annotation(target, annotation)
+            except NameError:
+                continue
+        deps[p_name] = Dependency(type=annotation, factory=p.default.factory if isinstance(p.default, Dependency) else annotation)
+    return deps
+
+
+_resolved_dependencies = WeakCache(_resolved_dependencies)
+
+
+def _signature_dependencies(dependent: typing.Callable) -> typing.Dict[str, Dependency]:
+    dependent_sig = inspect.signature(dependent)
+    deps: typing.Dict[str, Dependency] = {
+        p_name: (
+            ForwardDependency.of(dependent, p_name)
+            if isinstance(p.annotation, (str, typing.ForwardRef)) else
+            Dependency(type=p.annotation, factory=p.default.factory if isinstance(p.default, Dependency) else p.annotation)
+        )
+        for p_name, p in dependent_sig.parameters.items()
+    }
+    return deps
+
+
+_signature_dependencies = WeakCache(
+    _signature_dependencies,
+    stamp=lambda dependent: (getattr(dependent, "__signature__", None), getattr(dependent, "__wrapped__", None)),
+)
+
+
 def extract_dependencies(dependent: typing.Callable) -> typing.Dict[str, Dependency]:
     """
     Given a callable(usually class or function), identify dependencies
-    by looking at attributes or signature
+    by looking at attributes or signature.
+    Signature inspection is memoized per callable until its `__signature__` changes;
+    `__dependencies__` is always read from the callable.
     """
     if hasattr(dependent, "__dependencies__"):
         return dependent.__dependencies__
     else:
-        dependent_sig = inspect.signature(dependent)
-        deps: typing.Dict[str, Dependency] = {
-            p_name: Dependency(type=p.annotation, factory=p.default.factory if isinstance(p.default, Dependency) else p.annotation)
-            for p_name, p in dependent_sig.parameters.items()
+        return dict(_signature_dependencies(dependent))
+
+
+extract_dependencies.cache_info = _signature_dependencies.cache_info
+extract_dependencies.cache_clear = _signature_dependencies.cache_clear
+
+
+def bind_dependencies(dependent: typing.Callable, dependencies: typing.Iterable[Node]) -> typing.Dict[str, Node]:
+    """
+    Match the parameters of `dependent` with dependency nodes, by node name first, then by dependency type.
+    If the signature cannot be inspected, every dependency is passed as a keyword argument named after its node.
+    """
+    dependencies = list(dependencies)
+    try:
+        parameters = extract_dependencies(dependent)
+    except (ValueError, TypeError):
+        return {d.name: d for d in dependencies}
+
+    by_name = {d.name: d for d in dependencies}
+    by_type = {}
+    for d in dependencies:
+        by_type.setdefault(d.dependency_type.type, d)
+
+    binding = {}
+    for p_name, p in parameters.items():
+        d = by_name.get(p_name)
+        if d is None:
+            try:
+                d = by_type.get(p.type)
+            except (TypeError, NameError):
+                # unhashable annotation, or forward reference that does not resolve: left unbound
+                continue
+        if d is not None:
+            binding[p_name] = d
+    return binding
+
+
+class Plan(RecordBase):
+    """Construction of a root compiled to a function, valid as long as the root's resolution order is unchanged"""
+    order: typing.Tuple[Node, ...]
+    resolve: typing.Callable[[], typing.Any]
+    source: str
+
+
+_MISSING = object()
+
+
+class Provider:
+    """
+    Runtime provider: build the instance of a graph node after its dependencies, which are passed as arguments.
+    Instances are cached according to the scope of their dependency:
+    singleton per provider, per thread, per context (see `scope`), or not at all (transient).
+    """
+    def __init__(self, graph: DepGraph):
+        self.graph = graph
+        self.instances: typing.Dict[str, typing.Any] = {}
+        self._thread_instances = threading.local()
+        self._context_instances: contextvars.ContextVar[typing.Dict[str, typing.Any]] = contextvars.ContextVar(
+            f"{type(self).__name__}.instances"
+        )
+        self._plans: typing.Dict[str, Plan] = {}
+        # called as hook(node, path) around each Dependency.provide call, returning a context manager
+        self.hooks: typing.List[typing.Callable[[Node, typing.Tuple[str, ...]], typing.ContextManager]] = []
+
+    @contextlib.contextmanager
+    def scope(self):
+        """Fresh cache for context scoped dependencies, e.g. for the duration of a request"""
+        token = self._context_instances.set({})
+        try:
+            yield
+        finally:
+            self._context_instances.reset(token)
+
+    def _context_cache(self) -> typing.Dict[str, typing.Any]:
+        try:
+            return self._context_instances.get()
+        except LookupError:
+            instances = {}
+            self._context_instances.set(instances)
+            return instances
+
+    def _thread_cache(self) -> typing.Dict[str, typing.Any]:
+        try:
+            return self._thread_instances.instances
+        except AttributeError:
+            instances = self._thread_instances.instances = {}
+            return instances
+
+    def _cache(self, dependency: Dependency) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        scope = dependency.scope
+        if scope is Scope.SINGLETON:
+            return self.instances
+        elif scope is Scope.THREAD:
+            return self._thread_cache()
+        elif scope is Scope.CONTEXT:
+            return self._context_cache()
+        else:
+            return None
+
+    def _arguments(self, node: Node, instances: typing.Mapping[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        binding = bind_dependencies(node.dependency_type.factory, self.graph.get_dependencies(node.name))
+        return {
+            p_name: LazyProxy(functools.partial(self._provide_lazily, d.name)) if d.dependency_type.lazy else instances[d.name]
+            for p_name, d in binding.items()
+        }
+
+    def _provide_lazily(self, name: str):
+        """Target of the LazyProxy injected for `name`"""
+        return self.provide(name)
+
+    def _instrument(self, node: Node, path: typing.Tuple[str, ...]) -> typing.ContextManager:
+        """Enter the hooks around the construction of `node`, required through `path`"""
+        if not self.hooks:
+            return contextlib.nullcontext()
+        stack = contextlib.ExitStack()
+        with stack:
+            for hook in self.hooks:
+                stack.enter_context(hook(node, path))
+            return stack.pop_all()
+
+    def _paths(self, order: typing.Sequence[Node]) -> typing.Dict[Node, typing.Tuple[str, ...]]:
+        """Path from the root through which each node of an (eager) resolution order is first required"""
+        paths = {order[-1]: (order[-1].name,)}
+        for node in reversed(order):
+            for d in self.graph.get_dependencies(node.name):
+                if d not in paths and not d.dependency_type.lazy:
+                    paths[d] = (*paths[node], d.name)
+        return paths
+
+    def eager_order(self, name: str) -> typing.Tuple[Node, ...]:
+        """Resolution order of `name`, without the nodes only reachable through lazy dependencies"""
+        order = self.graph.resolution_order(name)
+        needed = {order[-1]}
+        for node in reversed(order):
+            if node in needed:
+                needed.update(d for d in self.graph.get_dependencies(node.name) if not d.dependency_type.lazy)
+        return tuple(n for n in order if n in needed)
+
+    def _build_order(self, name: str) -> typing.Tuple[typing.Tuple[Node, ...], typing.Dict[str, typing.Any]]:
+        """
+        Nodes of the eager order of `name` to build, i.e. reached from it through nodes not cached yet,
+        and the cached instances they depend on
+        """
+        order = self.eager_order(name)
+        needed = {order[-1]}
+        build = []
+        instances = {}
+        for node in reversed(order):
+            if node not in needed:
+                continue
+            cache = self._cache(node.dependency_type)
+            if cache is not None and node.name in cache:
+                instances[node.name] = cache[node.name]
+            else:
+                build.append(node)
+                needed.update(d for d in self.graph.get_dependencies(node.name) if not d.dependency_type.lazy)
+        return tuple(reversed(build)), instances
+
+    def compile(self, name: str) -> Plan:
+        """
+        Generate a function building `name` with its dependencies in resolution order,
+        with factories, arguments and scope caches resolved ahead of time.
+        Transient instances are shared by all their dependents within one resolution.
+        A first pass down from `name` looks up the caches, so that only the nodes required by a node being built are built,
+        and not the dependencies of a cached node.
+        """
+        order = self.eager_order(name)
+        ids = {node: i for i, node in enumerate(order)}
+        namespace = {
+            "MISSING": _MISSING,
+            "Lazy": LazyProxy,
+            "instances": self.instances,
+            "thread_cache": self._thread_cache,
+            "context_cache": self._context_cache,
+        }
+        caches = {
+            Scope.SINGLETON: ("singleton", "instances"),
+            Scope.THREAD: ("thread", "thread_cache()"),
+            Scope.CONTEXT: ("context", "context_cache()"),
         }
-        return deps
 
+        lines = ["def resolve():"]
+        for scope in caches.keys() & {node.dependency_type.scope for node in order}:
+            lines.append("    {} = {}".format(*caches[scope]))
+        root_scope = order[-1].dependency_type.scope
+        if root_scope in caches:
+            lines.append(f"    instance = {caches[root_scope][0]}.get({name!r}, MISSING)")
+            lines.append("    if instance is not MISSING: return instance")
+
+        # first pass, from the root down: n{i} tells whether node i is built, when not known ahead of time
+        # (plans are flat, as nesting the builds in their dependents would exceed the indentation limit on deep graphs)
+        built = {len(order) - 1}
+        for i in range(len(order) - 2, -1, -1):
+            node = order[i]
+            dependents = sorted(ids[d] for d in self.graph.get_dependents(node.name) if d in ids)
+            needed = " or ".join(f"n{j}" for j in dependents)
+            scope = node.dependency_type.scope
+            if scope not in caches:
+                if built.intersection(dependents):
+                    built.add(i)
+                else:
+                    lines.append(f"    n{i} = {needed}")
+            elif built.intersection(dependents):
+                lines.append(f"    v{i} = {caches[scope][0]}.get({node.name!r}, MISSING)")
+                lines.append(f"    n{i} = v{i} is MISSING")
+            else:
+                lines.append(f"    if {needed}:")
+                lines.append(f"        v{i} = {caches[scope][0]}.get({node.name!r}, MISSING)")
+                lines.append(f"        n{i} = v{i} is MISSING")
+                lines.append("    else:")
+                lines.append(f"        n{i} = False")
+
+        for i, node in enumerate(order):
+            namespace[f"f{i}"] = node.dependency_type.provide
+            binding = bind_dependencies(node.dependency_type.factory, self.graph.get_dependencies(node.name))
+            values = {}
+            for p_name, d in binding.items():
+                if d.dependency_type.lazy:
+                    namespace[f"l{i}_{p_name}"] = functools.partial(self._provide_lazily, d.name)
+                    values[p_name] = f"Lazy(l{i}_{p_name})"
+                else:
+                    values[p_name] = f"v{ids[d]}"
+            arguments = [f"{p_name}={v}" for p_name, v in values.items() if p_name.isidentifier() and not keyword.iskeyword(p_name)]
+            others = [f"{p_name!r}: {v}" for p_name, v in values.items() if not p_name.isidentifier() or keyword.iskeyword(p_name)]
+            if others:
+                arguments.append("**{" + ", ".join(others) + "}")
+            call = f"f{i}({', '.join(arguments)})"
+
+            scope = node.dependency_type.scope
+            build = f"v{i} = {call}" if scope not in caches else f"v{i} = {caches[scope][0]}[{node.name!r}] = {call}"
+            lines.append(f"    {build}" if i in built else f"    if n{i}: {build}")
+        lines.append(f"    return v{len(order) - 1}")
+
+        source = "\n".join(lines)
+        exec(compile(source, f"<plan {name}>", "exec"), namespace)
+        return Plan(order=self.graph.resolution_order(name), resolve=namespace["resolve"], source=source)
+
+    def provide(self, name: str):
+        if self.hooks:
+            return self._provide_instrumented(name)
+        plan = self._plans.get(name)
+        if plan is None or plan.order is not self.graph.resolution_order(name):
+            plan = self._plans[name] = self.compile(name)
+        return plan.resolve()
+
+    def _provide_instrumented(self, name: str):
+        """Resolution without compiled plan, running the hooks around each construction"""
+        cache = self._cache(self.graph.get_by_name(name).dependency_type)
+        if cache is not None and name in cache:
+            return cache[name]
+
+        order, instances = self._build_order(name)
+        paths = self._paths(order)
+        for node in order:
+            cache = self._cache(node.dependency_type)
+            arguments = self._arguments(node, instances)
+            with self._instrument(node, paths[node]):
+                instance = instances[node.name] = node.dependency_type.provide(**arguments)
+            if cache is not None:
+                cache[node.name] = instance
+        return instances[name]
+
+
+class AsyncProvider(Provider):
+    """
+    Provider accepting `async def` factories (or any factory returning an awaitable).
+    Independent dependencies are built concurrently, and concurrent requests for the same cached node share a single build:
+    the scope caches of an async provider hold futures.
+    Lazy dependencies are provided eagerly, as a proxy cannot await its target on attribute access.
+    """
+    async def provide(self, name: str):
+        return await self._provide(name, (name,))
+
+    async def _provide(self, name: str, path: typing.Tuple[str, ...]):
+        import asyncio
+        # create the context cache before spawning tasks, so that they all share it
+        self._context_cache()
+        node = self.graph.get_by_name(name)
+        cache = self._cache(node.dependency_type)
+        if cache is None:
+            return await self._build(node, path)
+
+        try:
+            future = cache[name]
+        except KeyError:
+            future = cache[name] = asyncio.ensure_future(self._build(node, path))
+
+        try:
+            # shielded, so that a cancelled requester does not cancel the build shared with others
+            return await asyncio.shield(future)
+        except Exception:
+            if future.done() and cache.get(name) is future:
+                # let a later request retry a failed build
+                del cache[name]
+            raise
+
+    async def _build(self, node: Node, path: typing.Tuple[str, ...]):
+        import asyncio
+        dependencies = self.graph.get_dependencies(node.name)
+        instances = await asyncio.gather(*(self._provide(d.name, (*path, d.name)) for d in dependencies))
+        instances = {d.name: instance for d, instance in zip(dependencies, instances)}
+
+        binding = bind_dependencies(node.dependency_type.factory, dependencies)
+        with self._instrument(node, path):
+            instance = node.dependency_type.provide(**{p_name: instances[d.name] for p_name, d in binding.items()})
+            if inspect.isawaitable(instance):
+                instance = await instance
+        return instance
+
+
+class ThreadPoolProvider(Provider):
+    """
+    Provider running blocking factories on a thread pool.
+    A node is submitted as soon as all of its dependencies are built; when a factory fails,
+    work that was not started yet is cancelled and ProvisionError is raised for the failed node.
+    Concurrent calls to `provide` are serialized, each one building its subgraph in parallel.
+    Thread and context scoped instances are cached for the thread and context calling `provide`.
+    Lazy dependencies are built in the thread first using them, without going through the pool.
+    """
+    def __init__(self, graph: DepGraph, max_workers: typing.Optional[int] = None,
+                 executor: typing.Optional[_Executor] = None):
+        import concurrent.futures
+        super().__init__(graph)
+        self._owns_executor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="provider")
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        if self._owns_executor:
+            self.executor.shutdown(wait=wait)
+
+    def _provide_lazily(self, name: str):
+        # a factory running in the pool may use a lazy dependency while `provide` holds the lock
+        return Provider.provide(self, name)
+
+    def _build(self, node: Node, path: typing.Tuple[str, ...], arguments: typing.Dict[str, typing.Any]):
+        with self._instrument(node, path):
+            return node.dependency_type.provide(**arguments)
+
+    def provide(self, name: str):
+        cache = self._cache(self.graph.get_by_name(name).dependency_type)
+        if cache is not None and name in cache:
+            return cache[name]
+
+        import concurrent.futures
+        with self._lock:
+            todo, instances = self._build_order(name)
+            subgraph = set(todo)
+            pending = {
+                n: sum(1 for d in self.graph.get_dependencies(n.name) if d in subgraph)
+                for n in todo
+            }
+            paths = self._paths(todo) if self.hooks else {}
+            running: typing.Dict[concurrent.futures.Future, Node] = {}
+
+            def submit(node: Node):
+                arguments = self._arguments(node, instances)
+                if self.hooks:
+                    # hooks run in the worker, in a copy of the calling context
+                    future = self.executor.submit(contextvars.copy_context().run, self._build, node, paths[node], arguments)
+                else:
+                    future = self.executor.submit(node.dependency_type.provide, **arguments)
+                running[future] = node
+
+            for node in todo:
+                if not pending[node]:
+                    submit(node)
+
+            failed = None
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    if future.cancelled():
+                        continue
+                    error = future.exception()
+                    if error is not None:
+                        if failed is None:
+                            failed = node, error
+                            for f in running:
+                                f.cancel()
+                        continue
+
+                    instance = instances[node.name] = future.result()
+                    cache = self._cache(node.dependency_type)
+                    if cache is not None:
+                        cache[node.name] = instance
+                    if failed is None:
+                        for d in self.graph.get_dependents(node.name):
+                            if d in subgraph:
+                                pending[d] -= 1
+                                if not pending[d]:
+                                    submit(d)
+
+            if failed is not None:
+                node, error = failed
+                raise ProvisionError(node.name) from error
+            return instances[name]
+
+class ProvideRecord(RecordBase):
+    # names from the outermost requested node down to the built node
+    stack: typing.Tuple[str, ...]
+    # seconds spent in the factory, excluding constructions nested in it
+    elapsed: float
+    # bytes allocated and still held when the factory returned, when tracing allocations
+    allocated: typing.Optional[int] = None
+
+
+class ProvideRecorder:
+    """
+    Provider hook recording the construction time of each node, and optionally its tracemalloc allocation delta.
+    Constructions nested in a factory (e.g. a lazy dependency used by it) are recorded under its stack.
+
+        recorder = ProvideRecorder()
+        provider.hooks.append(recorder)
+        provider.provide("app")
+        recorder.write_folded("startup.folded")  # flamegraph.pl / speedscope input
+    """
+    def __init__(self, trace_allocations: bool = False):
+        self.records: typing.List[ProvideRecord] = []
+        self.trace_allocations = trace_allocations
+        if trace_allocations:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+        # (stack, nested elapsed time accumulator) of the construction in progress
+        self._current: contextvars.ContextVar[typing.Tuple[typing.Tuple[str, ...], typing.List[float]]] = contextvars.ContextVar(
+            "ProvideRecorder.current", default=((), [0.0])
+        )
+
+    @contextlib.contextmanager
+    def __call__(self, node: Node, path: typing.Tuple[str, ...]):
+        enclosing, enclosing_nested = self._current.get()
+        stack = enclosing + path
+        nested = [0.0]
+        token = self._current.set((stack, nested))
+        if self.trace_allocations:
+            import tracemalloc
+            allocated = tracemalloc.get_traced_memory()[0]
+        else:
+            allocated = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if allocated is not None:
+                allocated = tracemalloc.get_traced_memory()[0] - allocated
+            self._current.reset(token)
+            enclosing_nested[0] += elapsed
+            self.records.append(ProvideRecord(stack=stack, elapsed=elapsed - nested[0], allocated=allocated))
+
+    def folded(self, allocations: bool = False) -> str:
+        """
+        Collapsed stacks, one `name;name;... value` line per stack,
+        valued in microseconds, or in allocated bytes if `allocations`
+        """
+        totals = collections.Counter()
+        for record in self.records:
+            if allocations:
+                totals[record.stack] += max(record.allocated or 0, 0)
+            else:
+                totals[record.stack] += round(record.elapsed * 1e6)
+        return "".join(f"{';'.join(stack)} {value}\n" for stack, value in totals.items())
+
+    def write_folded(self, path: str, allocations: bool = False):
+        with open(path, "w") as f:
+            f.write(self.folded(allocations))
+
+    def durations(self) -> typing.Dict[str, float]:
+        """Construction time of each node, in seconds"""
+        durations = collections.Counter()
+        for record in self.records:
+            durations[record.stack[-1]] += record.elapsed
+        return dict(durations)
+
+
+class CriticalPath(RecordBase):
+    # longest chain of constructions, from a dependency without dependencies up to the root
+    path: typing.Tuple[str, ...]
+    # construction time of the root with unbounded parallelism
+    length: float
+    # how much each node's construction can be delayed without delaying the root's
+    slack: typing.Dict[str, float]
+
+
+def critical_path(graph: DepGraph, name: str, durations: typing.Mapping[str, float]) -> CriticalPath:
+    """
+    Critical path of the construction of `name`, given per-node construction times (missing ones count as 0),
+    assuming every node is built as soon as its dependencies are
+    """
+    order = graph.resolution_order(name)
+    subgraph = set(order)
+    finish = {}
+    longest = {}
+    for node in order:
+        start = 0.0
+        for d in graph.get_dependencies(node.name):
+            if finish[d] >= start:
+                start = finish[d]
+                longest[node] = d
+        finish[node] = start + durations.get(node.name, 0.0)
+
+    root = order[-1]
+    latest_finish = {root: finish[root]}
+    for node in reversed(order[:-1]):
+        latest_finish[node] = min(
+            latest_finish[d] - durations.get(d.name, 0.0)
+            for d in graph.get_dependents(node.name)
+            if d in subgraph
+        )
+
+    path = [root]
+    while path[-1] in longest:
+        path.append(longest[path[-1]])
+    return CriticalPath(
+        path=tuple(n.name for n in reversed(path)),
+        length=finish[root],
+        slack={n.name: latest_finish[n] - finish[n] for n in order},
+    )
+
+
+def format_critical_path(report: CriticalPath, durations: typing.Mapping[str, float]) -> str:
+    lines = [f"critical path: {report.length * 1e3:.3f} ms"]
+    lines += [f"  {durations.get(name, 0.0) * 1e3:>12.3f} ms  {name}" for name in report.path]
+    lines.append("slack:")
+    lines += [
+        f"  {slack * 1e3:>12.3f} ms  {name} ({durations.get(name, 0.0) * 1e3:.3f} ms)"
+        for name, slack in sorted(report.slack.items(), key=lambda item: (item[1], item[0]))
+    ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+    import importlib
+    import json
+
+    parser = argparse.ArgumentParser(prog="deps")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser(
+        "critical-path",
+        help="startup critical path of a node, measured by providing it or from recorded construction times",
+    )
+    command.add_argument("graph", help="module:attribute of the DepGraph")
+    command.add_argument("name", help="node to provide")
+    command.add_argument("--timings", help="JSON file mapping node names to construction times in seconds")
+    args = parser.parse_args(argv)
+
+    module, _, attribute = args.graph.partition(":")
+    graph = getattr(importlib.import_module(module), attribute)
+    if args.timings:
+        with open(args.timings) as f:
+            durations = json.load(f)
+    else:
+        recorder = ProvideRecorder()
+        provider = Provider(graph)
+        provider.hooks.append(recorder)
+        provider.provide(args.name)
+        durations = recorder.durations()
+    print(format_critical_path(critical_path(graph, args.name, durations), durations))
+
+
+if __name__ == "__main__":
+    # run from the importable module, so that graphs loaded by the CLI share its classes (e.g. Scope)
+    import deps
+    deps.main()
 
     
     
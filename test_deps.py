@@ -0,0 +1,151 @@
+import contextlib
+import copy
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+import pytest
+
+import deps
+
+
+def make_node(name: str) -> deps.Node:
+    return deps.Node(name=name, dependency_type=deps.Dependency(factory=int, type=int, scope=deps.Scope.THREAD))
+
+
+def test_frozen_record_copy():
+    node = make_node("a")
+    hash(node)
+    for duplicate in (copy.copy(node), copy.deepcopy(node)):
+        assert duplicate == node
+        assert hash(duplicate) == hash(node)
+
+
+def test_frozen_record_pickle():
+    node = make_node("a")
+    hash(node)
+    loaded = pickle.loads(pickle.dumps(node))
+    assert loaded == node
+    assert loaded in {node}
+
+
+def test_frozen_record_pickle_across_processes():
+    # str hashes differ between processes: a pickled node must not carry its cached hash
+    script = "import pickle, sys, test_deps; node = test_deps.make_node('a'); hash(node); sys.stdout.buffer.write(pickle.dumps(node))"
+    env = dict(os.environ, PYTHONHASHSEED="1", PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    data = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, check=True).stdout
+    loaded = pickle.loads(data)
+    assert loaded in {make_node("a")}
+    assert hash(loaded) == hash(make_node("a"))
+
+
+def test_provide_skips_dependencies_of_cached_nodes():
+    built = []
+
+    def factory(name):
+        def provide(**dependencies):
+            built.append(name)
+            return name
+        return provide
+
+    graph = deps.DepGraph()
+    transient = deps.Node("t", deps.Dependency(factory("t"), str, scope=deps.Scope.TRANSIENT))
+    singleton = deps.Node("s", deps.Dependency(factory("s"), str))
+    graph.add_node(transient)
+    graph.add_node(singleton, [transient])
+    graph.add_node(deps.Node("h", deps.Dependency(factory("h"), str, scope=deps.Scope.TRANSIENT)), [singleton])
+
+    instrumented = deps.Provider(graph)
+    instrumented.hooks.append(lambda node, path: contextlib.nullcontext())
+    with deps.ThreadPoolProvider(graph) as pool:
+        for provider in (deps.Provider(graph), instrumented, pool):
+            built.clear()
+            provider.provide("h")
+            provider.provide("h")
+            assert built == ["t", "s", "h", "h"]
+
+
+def test_lazy_proxy_resolves_once_across_threads():
+    calls = []
+    barrier = threading.Barrier(8)
+
+    def factory():
+        calls.append(None)
+        time.sleep(0.01)
+        return []
+
+    for _ in range(20):
+        calls.clear()
+        proxy = deps.LazyProxy(factory)
+
+        def use():
+            barrier.wait()
+            len(proxy)
+
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert repr(proxy) == "[]"
+
+
+def test_child_graph_cycles_through_parent_and_own_edges():
+    a, b, c, d = map(make_node, "abcd")
+    parent = deps.DepGraph()
+    parent.add_node(b, [a])
+    parent.add_node(d, [c])
+    child = parent.child()
+    assert [n.name for n in child.resolution_order("d")] == ["c", "d"]
+    child.add_relationship("c", "b")
+    assert [n.name for n in child.resolution_order("d")] == ["a", "b", "c", "d"]
+    with pytest.raises(deps.CyclicDependencyError):
+        child.add_relationship("a", "d")
+    child.add_node(make_node("e"), [d])
+    assert child.depends_on("e", "a")
+
+
+class Closer(typing.Protocol):
+    def close(self): ...
+
+
+class Closing:
+    def close(self):
+        pass
+
+
+def test_find_by_type_extends_cached_protocol_lookups():
+    graph = deps.DepGraph()
+    closing = deps.Node("closing", deps.Dependency(Closing, Closing))
+    graph.add_node(closing)
+    assert graph.find_by_type(Closer) == {closing}
+    graph.add_node(make_node("number"))
+    assert graph.find_by_type(Closer) == {closing}
+    other = deps.Node("other", deps.Dependency(Closing, type("OtherClosing", (), {"close": lambda self: None})))
+    graph.add_node(other)
+    assert graph.find_by_type(Closer) == {closing, other}
+
+
+def test_thread_pool_provider_annotations_resolve():
+    hints = typing.get_type_hints(deps.ThreadPoolProvider.__init__)
+    assert deps.extract_dependencies(deps.ThreadPoolProvider)["executor"].type == hints["executor"]
+
+
+def test_add_nodes_new_nodes_in_any_listing_order():
+    graph = deps.DepGraph()
+    graph.add_node(make_node("base"))
+    chain = [make_node(f"n{i}") for i in range(6)]
+    dependency_first = [(chain[0], [graph.get_by_name("base")])] + [(chain[i], [chain[i - 1]]) for i in (1, 2)]
+    graph.add_nodes(dependency_first)
+    graph.add_nodes([(chain[i], [chain[i - 1]]) for i in (5, 4, 3)])
+    assert [n.name for n in graph.resolution_order("n5")] == ["base", *(n.name for n in chain)]
+    assert graph.depends_on("n5", "base")
+
+    with pytest.raises(deps.CyclicDependencyError):
+        graph.add_nodes([(make_node("x"), [make_node("y")]), (make_node("y"), [make_node("x")])])
+    assert "x" not in graph and "y" not in graph